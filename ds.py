@@ -1,35 +1,281 @@
+import functools
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator
+
+from cachetools import TTLCache
 from irods.access import iRODSAccess
-from irods.exception import UserDoesNotExist
+from irods.exception import (
+    CAT_NO_ROWS_FOUND,
+    CAT_UNKNOWN_COLLECTION,
+    CollectionDoesNotExist,
+    DataObjectDoesNotExist,
+    UserDoesNotExist,
+)
 from irods.models import User
 from irods.path import iRODSPath
 from irods.session import iRODSSession
 from irods.user import iRODSUser
 
+__all__ = ["DataStoreAPI", "LookupCache", "SessionPool"]
+
+
+class SessionPool(object):
+    """
+    A fixed-size pool of iRODS sessions that can be shared between threads.
+
+    Each session holds its own connection to iRODS, so a caller that has
+    acquired a session never waits on another caller's in-flight request.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        host: str,
+        port: str,
+        user: str,
+        password: str,
+        zone: str,
+        connection_timeout: int,
+        refresh_time: int,
+    ):
+        if size < 1:
+            raise ValueError("the session pool size must be at least 1")
+
+        self.size = size
+        self._sessions: queue.Queue[iRODSSession] = queue.Queue(maxsize=size)
+        for _ in range(size):
+            # refresh_time has python-irodsclient replace a connection once it
+            # gets older than that many seconds, so long-lived sessions never
+            # hand out a connection the server or a firewall has dropped.
+            session = iRODSSession(
+                host=host,
+                port=port,
+                user=user,
+                password=password,
+                zone=zone,
+                refresh_time=refresh_time,
+            )
+            session.connection_timeout = connection_timeout
+            self._sessions.put(session)
+        self._user = user
+        self._zone = zone
+
+    @contextmanager
+    def acquire(self) -> Iterator[iRODSSession]:
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def warm(self) -> None:
+        """
+        Open and authenticate a connection in every session up front, so the
+        first requests to use each one don't pay for the handshake.
+        """
+        sessions = [self._sessions.get() for _ in range(self.size)]
+        try:
+            for session in sessions:
+                session.users.get(self._user, self._zone)
+        finally:
+            for session in sessions:
+                self._sessions.put(session)
+
+    def cleanup(self) -> None:
+        for _ in range(self.size):
+            with self.acquire() as session:
+                session.cleanup()
+
+
+class LookupCache(object):
+    """
+    A thread-safe TTL cache for the results of iRODS lookups.
+
+    Positive results are kept for ttl seconds and negative results for
+    negative_ttl seconds. Results of either kind aren't cached at all when
+    their TTL is zero. A lookup that was already in flight when a key was invalidated does
+    not store its result, so a mutation is never hidden by a stale answer
+    computed before it.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float = 0):
+        self._maxsize = maxsize
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl) if ttl > 0 else None
+        self._negative_cache = (
+            TTLCache(maxsize=maxsize, ttl=negative_ttl) if negative_ttl > 0 else None
+        )
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            for cache in self._caches():
+                try:
+                    value = cache[key]
+                    self.hits += 1
+                    return value
+                except KeyError:
+                    pass
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._generation += 1
+            self._store(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._generation += 1
+            for cache in self._caches():
+                cache.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        with self._lock:
+            self._generation += 1
+            for cache in self._caches():
+                for key in [k for k in cache.keys() if predicate(k)]:
+                    cache.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": self._cache.currsize if self._cache is not None else 0,
+                "negative_size": (
+                    self._negative_cache.currsize
+                    if self._negative_cache is not None
+                    else 0
+                ),
+                "maxsize": self._maxsize,
+            }
+
+    def _caches(self) -> list[TTLCache]:
+        return [c for c in (self._cache, self._negative_cache) if c is not None]
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        # Callers hold self._lock. A value stored for a key replaces any
+        # cached answer of the opposite kind.
+        for cache in self._caches():
+            cache.pop(key, None)
+        if value:
+            if self._cache is not None:
+                self._cache[key] = value
+        elif self._negative_cache is not None:
+            self._negative_cache[key] = value
+
+
+@functools.lru_cache(maxsize=8192)
+def _home_dir(zone: str, username: str) -> iRODSPath:
+    return iRODSPath("/".join(("", zone, "home", username)))
+
+
+def _is_ancestor_or_self(ancestor: str, path: str) -> bool:
+    return path == ancestor or path.startswith(ancestor.rstrip("/") + "/")
+
 
 class DataStoreAPI(object):
     _user_type = "rodsuser"
+    _cache_maxsize = 10_000
 
-    def __init__(self, host: str, port: str, user: str, password: str, zone: str):
-        self.session = iRODSSession(
-            host=host, port=port, user=user, password=password, zone=zone
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        user: str,
+        password: str,
+        zone: str,
+        pool_size: int = 16,
+        connection_timeout: int = 120,
+        refresh_time: int = 300,
+        path_cache_ttl: int = 0,
+        user_cache_ttl: int = 0,
+        user_negative_ttl: int = 0,
+    ):
+        self.pool = SessionPool(
+            pool_size,
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            zone=zone,
+            connection_timeout=connection_timeout,
+            refresh_time=refresh_time,
         )
-        self.session.connection_timeout = None
+        self.pool.warm()
         self.host = host
         self.port = port
         self.user = user
         self.zone = zone
 
-    def path_exists(self, a_path: str) -> bool:
+        # Paths are never cached as missing, and are only cached as existing if
+        # path_cache_ttl is set: data objects are uploaded to and removed from
+        # iRODS directly, so this service can't know when a path changes.
+        # Users are likewise only cached if user_cache_ttl or user_negative_ttl
+        # is set, since another replica may create or delete a user at any time.
+        self.path_cache = LookupCache(self._cache_maxsize, path_cache_ttl)
+        self.user_cache = LookupCache(
+            self._cache_maxsize, user_cache_ttl, negative_ttl=user_negative_ttl
+        )
+
+        # The permissions a zone supports don't change while it's running, so
+        # they're only fetched once.
+        self._perms = self._list_available_permissions()
+        self._perms_set = frozenset(self._perms)
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            "paths": self.path_cache.stats(),
+            "users": self.user_cache.stats(),
+        }
+
+    def path_exists(self, a_path: str, cached: bool = True) -> bool:
+        """
+        Check whether a data object or collection exists at a path.
+
+        Callers about to write to the path should pass cached=False, since a
+        cached answer may miss a change made directly in iRODS.
+        """
         fixed_path = iRODSPath(a_path)
-        return self.session.data_objects.exists(
-            fixed_path
-        ) or self.session.collections.exists(fixed_path)
+        # Most paths name data objects, so those are checked first unless the
+        # caller marked the path as a collection with a trailing slash.
+        collection_hint = a_path.endswith("/")
+        if not cached:
+            return self._path_exists(fixed_path, collection_hint)
+        return self.path_cache.get(
+            fixed_path, lambda: self._path_exists(fixed_path, collection_hint)
+        )
+
+    def _path_exists(self, fixed_path: iRODSPath, collection_hint: bool) -> bool:
+        with self.pool.acquire() as session:
+            if collection_hint:
+                return session.collections.exists(
+                    fixed_path
+                ) or session.data_objects.exists(fixed_path)
+            return session.data_objects.exists(
+                fixed_path
+            ) or session.collections.exists(fixed_path)
 
     def user_exists(self, username: str) -> bool:
+        return self.user_cache.get(username, lambda: self._user_exists(username))
+
+    def _user_exists(self, username: str) -> bool:
         user_exists = False
 
         try:
-            user = self.session.users.get(username, self.zone)
+            user = self.get_user(username)
             user_exists = user is not None
         except UserDoesNotExist:
             user_exists = False
@@ -37,50 +283,112 @@ class DataStoreAPI(object):
         return user_exists
 
     def list_users_by_username(self, username: str) -> list[iRODSUser]:
-        return [
-            self.session.users.get(u[User.name], u[User.zone])
-            for u in self.session.query(User).filter(
-                User.name == username and User.zone == self.zone
+        with self.pool.acquire() as session:
+            query = session.query(User.id, User.name, User.type, User.zone).filter(
+                User.name == username, User.zone == self.zone
             )
-        ]
+            return [iRODSUser(session.users, row) for row in query]
 
-    def delete_home(self, username: str) -> None:
+    def delete_home(self, username: str) -> str:
         homedir = self.home_directory(username)
-        if self.session.collections.exists(homedir):
-            self.session.collections.remove(homedir, force=True, recurse=True)
+        try:
+            with self.pool.acquire() as session:
+                session.collections.remove(homedir, force=True, recurse=True)
+        except (CollectionDoesNotExist, CAT_NO_ROWS_FOUND, CAT_UNKNOWN_COLLECTION):
+            # The home directory is already gone.
+            pass
+        finally:
+            self.path_cache.invalidate_where(
+                lambda path: _is_ancestor_or_self(homedir, path)
+            )
+        return homedir
 
     def create_user(self, username: str) -> iRODSUser:
-        return self.session.users.create(username, DataStoreAPI._user_type)
+        try:
+            with self.pool.acquire() as session:
+                return session.users.create(username, DataStoreAPI._user_type)
+        finally:
+            self.user_cache.invalidate(username)
 
     def get_user(self, username: str) -> iRODSUser:
-        return self.session.users.get(username, self.zone)
+        with self.pool.acquire() as session:
+            return session.users.get(username, self.zone)
 
     def delete_user(self, username: str) -> None:
-        self.session.users.get(username, self.zone).remove()
+        try:
+            with self.pool.acquire() as session:
+                session.users.get(username, self.zone).remove()
+        finally:
+            self.user_cache.invalidate(username)
 
     def change_password(self, username: str, password: str) -> None:
-        self.session.users.modify(username, "password", password)
+        with self.pool.acquire() as session:
+            session.users.modify(username, "password", password)
+
+    def create_collection(self, path: str) -> None:
+        fixed_path = iRODSPath(path)
+        with self.pool.acquire() as session:
+            session.collections.create(fixed_path)
+        # Remember the new collection so the next check for it is answered locally.
+        self.path_cache.put(fixed_path, True)
 
     def chmod(self, username: str, permission: str, path: str) -> None:
         access = iRODSAccess(permission, iRODSPath(path), username)
-        self.session.acls.set(access)
+        with self.pool.acquire() as session:
+            session.acls.set(access)
+
+    def chmod_many(self, accesses: list[tuple[str, str, str]]) -> None:
+        """
+        Apply several permission changes using a single pooled session.
+
+        Args:
+            accesses: (username, permission, path) tuples, applied in order
+        """
+        acls = [
+            iRODSAccess(permission, iRODSPath(path), username)
+            for username, permission, path in accesses
+        ]
+        with self.pool.acquire() as session:
+            for acl in acls:
+                session.acls.set(acl)
 
-    def list_available_permissions(self) -> list[str]:
-        return self.session.available_permissions.keys()
+    def list_available_permissions(self) -> tuple[str, ...]:
+        return self._perms
 
-    def get_permissions(self, path: str) -> list[iRODSAccess]:
+    def permission_exists(self, permission: str) -> bool:
+        return permission in self._perms_set
+
+    def _list_available_permissions(self) -> tuple[str, ...]:
+        # iRODS lists permissions in ascending order of privilege.
+        with self.pool.acquire() as session:
+            return tuple(session.available_permissions.keys())
+
+    def get_permissions(self, path: str) -> list[dict[str, str]]:
         clean_path = iRODSPath(path)
 
-        obj = None
-        if self.session.data_objects.exists(clean_path):
-            obj = self.session.data_objects.get(clean_path)
-        else:
-            obj = self.session.collections.get(clean_path)
+        with self.pool.acquire() as session:
+            try:
+                obj = session.data_objects.get(clean_path)
+            except DataObjectDoesNotExist:
+                obj = session.collections.get(clean_path)
 
-        return self.session.acls.get(obj)
+            acls = session.acls.get(obj)
+
+        # Plain dicts with the same keys FastAPI produced from the iRODSAccess
+        # objects, but without it having to introspect each one.
+        return [
+            {
+                "access_name": acl.access_name,
+                "path": acl.path,
+                "user_name": acl.user_name,
+                "user_zone": acl.user_zone,
+                "user_type": acl.user_type,
+            }
+            for acl in acls
+        ]
 
     def home_directory(self, username: str) -> str:
-        return iRODSPath(f"/{self.zone}/home/{username}")
+        return _home_dir(self.zone, username)
 
     def ensure_user_exists(self, username: str) -> iRODSUser:
         """
@@ -95,19 +403,19 @@ class DataStoreAPI(object):
         Raises:
             Exception: If user or home directory creation fails
         """
-        # Check if user already exists
-        if self.user_exists(username):
+        # Most users already exist, so look the user up directly
+        try:
             return self.get_user(username)
+        except UserDoesNotExist:
+            pass
 
         # Create the user
         user = self.create_user(username)
 
-        # Ensure home directory exists
+        # Create the home directory, which does nothing if it already exists
         home_dir = self.home_directory(username)
-        if not self.path_exists(home_dir):
-            # Create home directory
-            self.session.collections.create(home_dir)
-            # Set ownership of home directory to the user
-            self.chmod(username=username, permission="own", path=home_dir)
+        self.create_collection(home_dir)
+        # Set ownership of home directory to the user
+        self.chmod(username=username, permission="own", path=home_dir)
 
         return user
@@ -1,21 +1,56 @@
+import asyncio
+import atexit
+import functools
+import logging
 import os
-import os.path
+import queue
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
+import anyio.to_thread
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+from irods.exception import CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME
+from irods.path import iRODSPath
 from pydantic import BaseModel
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 import ds
 
-app = FastAPI()
+# Log records are handed off to a queue and written to stderr by a
+# background thread, so logging never blocks a request on the write.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stderr))
+log_listener.start()
+atexit.register(log_listener.stop)
+log_handler = QueueHandler(log_queue)
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+logger = logging.getLogger("portal-datastore")
+logger.setLevel(logging.INFO)
+logger.addHandler(log_handler)
+logger.propagate = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep anything Starlette still runs on its own threadpool from being
+    # capped below the number of iRODS sessions.
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, ds_pool_size)
+    yield
+    executor.shutdown(wait=True)
+    server.pool.cleanup()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    print(exc, file=sys.stderr)
-    return JSONResponse(content={"detail": exc.detail}, status_code=exc.status_code)
+    logger.warning(exc)
+    return ORJSONResponse(content={"detail": exc.detail}, status_code=exc.status_code)
 
 
 @app.middleware("http")
@@ -23,80 +58,128 @@ async def exception_handling_middleware(request: Request, call_next):
     try:
         return await call_next(request)
     except Exception as e:
-        print(str(e), file=sys.stderr)
-        return JSONResponse(content=str(e), status_code=500)
+        logger.exception(e)
+        return ORJSONResponse(content=str(e), status_code=500)
 
 
 ds_host = os.environ.get("IRODS_HOST")
 if ds_host is None:
-    print("Environment variable IRODS_HOST is not set.", file=sys.stderr)
+    logger.error("Environment variable IRODS_HOST is not set.")
     sys.exit(1)
 
 ds_port = os.environ.get("IRODS_PORT")
 if ds_port is None:
-    print("Environment variable IRODS_PORT is not set.", file=sys.stderr)
+    logger.error("Environment variable IRODS_PORT is not set.")
     sys.exit(1)
 
 ds_user = os.environ.get("IRODS_USER")
 if ds_user is None:
-    print("Environment variable IRODS_USER is not set.", file=sys.stderr)
+    logger.error("Environment variable IRODS_USER is not set.")
     sys.exit(1)
 
 ds_password = os.environ.get("IRODS_PASSWORD")
 if ds_password is None:
-    print("Environment variable IRODS_PASSWORD is not set.", file=sys.stderr)
+    logger.error("Environment variable IRODS_PASSWORD is not set.")
     sys.exit(1)
 
 ds_zone = os.environ.get("IRODS_ZONE")
 if ds_zone is None:
-    print("Environment variable IRODS_ZONE is not set.", file=sys.stderr)
+    logger.error("Environment variable IRODS_ZONE is not set.")
+    sys.exit(1)
+
+ds_pool_size = os.environ.get("IRODS_POOL_SIZE", "16")
+if not ds_pool_size.isdigit() or int(ds_pool_size) < 1:
+    logger.error("Environment variable IRODS_POOL_SIZE must be a positive integer.")
+    sys.exit(1)
+ds_pool_size = int(ds_pool_size)
+
+# Caching paths is opt-in, because they can be created and removed directly in
+# iRODS without this service knowing.
+ds_path_cache_ttl = os.environ.get("IRODS_PATH_CACHE_TTL", "0")
+if not ds_path_cache_ttl.isdigit():
+    logger.error("Environment variable IRODS_PATH_CACHE_TTL must be a non-negative integer.")
+    sys.exit(1)
+ds_path_cache_ttl = int(ds_path_cache_ttl)
+
+# Caching users is opt-in, because another replica can create or delete a user
+# and this one would keep reporting the old answer until the entry expires.
+ds_user_cache_ttl = os.environ.get("IRODS_USER_CACHE_TTL", "0")
+if not ds_user_cache_ttl.isdigit():
+    logger.error("Environment variable IRODS_USER_CACHE_TTL must be a non-negative integer.")
+    sys.exit(1)
+ds_user_cache_ttl = int(ds_user_cache_ttl)
+
+ds_user_negative_ttl = os.environ.get("IRODS_USER_NEGATIVE_CACHE_TTL", "0")
+if not ds_user_negative_ttl.isdigit():
+    logger.error("Environment variable IRODS_USER_NEGATIVE_CACHE_TTL must be a non-negative integer.")
     sys.exit(1)
+ds_user_negative_ttl = int(ds_user_negative_ttl)
+
+server = ds.DataStoreAPI(
+    ds_host,
+    ds_port,
+    ds_user,
+    ds_password,
+    ds_zone,
+    pool_size=ds_pool_size,
+    path_cache_ttl=ds_path_cache_ttl,
+    user_cache_ttl=ds_user_cache_ttl,
+    user_negative_ttl=ds_user_negative_ttl,
+)
+
+# iRODS calls block, so they run on a dedicated executor sized to match the
+# session pool rather than on the event loop.
+executor = ThreadPoolExecutor(max_workers=ds_pool_size, thread_name_prefix="irods")
 
-server = ds.DataStoreAPI(ds_host, ds_port, ds_user, ds_password, ds_zone)
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
 
 @app.get("/", status_code=200)
-def hello():
-    return "Hello from portal-datastore."
+async def hello():
+    return {"message": "Hello from portal-datastore.", "caches": server.cache_stats()}
 
 
 @app.get("/path/exists", status_code=200)
-def path_exists(path: str):
+async def path_exists(path: str):
     if path == "":
         raise HTTPException(400, "path query parameter is not set")
-    exists = server.path_exists(path)
+    exists = await run_blocking(server.path_exists, path)
     return {"path": path, "exists": exists}
 
 
 @app.get("/users/{username}/exists", status_code=200)
-def user_exists(username: str):
+async def user_exists(username: str):
     if username == "":
         raise HTTPException(400, "username must not be empty")
-    exists = server.user_exists(username)
+    exists = await run_blocking(server.user_exists, username)
     return {"user": username, "exists": exists}
 
 
 @app.get("/permissions/available", status_code=200)
-def list_available_permissions():
-    list = server.list_available_permissions()
-    return {"permissions": list}
+async def list_available_permissions():
+    return {"permissions": list(server.list_available_permissions())}
 
 
 @app.get("/path/permissions", status_code=200)
-def path_permissions(path: str):
+async def path_permissions(path: str):
     if path == "":
         raise HTTPException(400, "path query parameter is not set")
-    perms = server.get_permissions(path)
+    perms = await run_blocking(server.get_permissions, path)
     return {"permissions": perms}
 
 
 @app.post("/users/{username}", status_code=200)
-def create_user(username: str):
+async def create_user(username: str):
     if username == "":
         raise HTTPException(400, "username must not be empty")
-    if server.user_exists(username):
+    # iRODS rejects duplicate users itself, so there's no need to check first
+    try:
+        irods_user = await run_blocking(server.create_user, username)
+    except CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
         raise HTTPException(400, "user exists")
-    irods_user = server.create_user(username)
     return {
         "user": irods_user.name,
         "type": irods_user.type,
@@ -105,15 +188,15 @@ def create_user(username: str):
 
 
 @app.delete("/users/{username}", status_code=200)
-def delete_user(username: str):
+async def delete_user(username: str):
     if username == "":
         raise HTTPException(400, "username must not be empty")
-    server.delete_user(username)
+    await run_blocking(server.delete_user, username)
     return {"user": username}
 
 
 @app.get("/users/{username}/home", status_code=200)
-def get_home_dir(username: str):
+async def get_home_dir(username: str):
     if username == "":
         raise HTTPException(400, "username must not be empty")
     home_dir = server.home_directory(username)
@@ -121,11 +204,11 @@ def get_home_dir(username: str):
 
 
 @app.delete("/users/{username}/home", status_code=200)
-def delete_home(username: str):
+async def delete_home(username: str):
     if username == "":
         raise HTTPException(400, "username must not be empty")
-    server.delete_home(username)
-    return {"user": username, "home": server.home_directory(username)}
+    home_dir = await run_blocking(server.delete_home, username)
+    return {"user": username, "home": home_dir}
 
 
 class PasswordChange(BaseModel):
@@ -133,10 +216,10 @@ class PasswordChange(BaseModel):
 
 
 @app.post("/users/{username}/password", status_code=200)
-def change_password(username: str, password_change: PasswordChange):
+async def change_password(username: str, password_change: PasswordChange):
     if username == "":
         raise HTTPException(400, "username must not be empty")
-    server.change_password(username, password_change.password)
+    await run_blocking(server.change_password, username, password_change.password)
     return {"user": username}
 
 
@@ -147,20 +230,26 @@ class PathPermission(BaseModel):
 
 
 @app.post("/path/chmod", status_code=200)
-def chmod(perm_change: PathPermission):
+async def chmod(perm_change: PathPermission):
     if perm_change.username == "":
         raise HTTPException(400, "username must be set in request body")
     if perm_change.path == "":
         raise HTTPException(400, "path must be set in request body")
     if perm_change.permission == "":
         raise HTTPException(400, "permission must be set in request body")
-    if not server.user_exists(perm_change.username):
+    user_exists, path_exists = await asyncio.gather(
+        run_blocking(server.user_exists, perm_change.username),
+        run_blocking(server.path_exists, perm_change.path, cached=False),
+    )
+    if not user_exists:
         raise HTTPException(400, f"username {perm_change.username} does not exist")
-    if perm_change.permission not in server.list_available_permissions():
+    if not server.permission_exists(perm_change.permission):
         raise HTTPException(400, f"permission {perm_change.permission} does not exist")
-    if not server.path_exists(perm_change.path):
+    if not path_exists:
         raise HTTPException(400, f"path {perm_change.path} does not exist")
-    server.chmod(perm_change.username, perm_change.permission, perm_change.path)
+    await run_blocking(
+        server.chmod, perm_change.username, perm_change.permission, perm_change.path
+    )
     return perm_change
 
 
@@ -171,44 +260,67 @@ class ServiceRegistration(BaseModel):
 
 
 @app.post("/services/register", status_code=200)
-def service_registration(registration: ServiceRegistration):
+async def service_registration(registration: ServiceRegistration):
     if registration.username == "":
         raise HTTPException(400, "username must not be empty")
     if registration.irods_path == "":
         raise HTTPException(400, "irods_path must not be empty")
 
-    # Ensure user exists (create if necessary)
-    try:
-        user = server.ensure_user_exists(registration.username)
-        print(f"User {registration.username} is ready for service registration", file=sys.stderr)
-    except Exception as e:
-        print(f"Failed to ensure user {registration.username} exists: {str(e)}", file=sys.stderr)
-        raise HTTPException(500, f"Failed to prepare user {registration.username}: {str(e)}")
-
     home_dir = server.home_directory(registration.username)
 
-    full_path = os.path.join(home_dir, registration.irods_path)
-    if not server.path_exists(full_path):
-        server.session.collections.create(full_path)
+    # Later elements are always relative, so a leading slash can't escape home_dir
+    full_path = iRODSPath(home_dir, registration.irods_path)
+    if not full_path.startswith(home_dir + "/"):
+        raise HTTPException(400, "irods_path must be inside the user's home directory")
+
+    # Ensure user exists (create if necessary) while checking for the path,
+    # which is read-only and doesn't depend on the user
+    user_result, path_exists = await asyncio.gather(
+        run_blocking(server.ensure_user_exists, registration.username),
+        run_blocking(server.path_exists, full_path, cached=False),
+        return_exceptions=True,
+    )
+    # Cancellation is a BaseException rather than an Exception, so both results
+    # are checked against BaseException to keep it from passing as a result
+    if isinstance(user_result, Exception):
+        logger.error(
+            "Failed to ensure user %s exists", registration.username, exc_info=user_result
+        )
+        raise HTTPException(500, f"Failed to prepare user {registration.username}: {str(user_result)}")
+    if isinstance(user_result, BaseException):
+        raise user_result
+    if isinstance(path_exists, BaseException):
+        raise path_exists
+    logger.info("User %s is ready for service registration", registration.username)
+
+    # The collection is only created once the user and their home directory exist
+    if not path_exists:
+        await run_blocking(server.create_collection, full_path)
 
     # Set permissions idempotently - check current permissions first
-    current_perms = server.get_permissions(full_path)
+    current_perms = await run_blocking(server.get_permissions, full_path)
+
+    # Collect the permissions that aren't already set so they can be applied together
+    changes = []
 
     # Set inherit permission if not already set
-    inherit_set = any(perm.user_name == "" and perm.access_name == "inherit" for perm in current_perms)
+    inherit_set = any(perm["user_name"] == "" and perm["access_name"] == "inherit" for perm in current_perms)
     if not inherit_set:
-        server.chmod(username="", permission="inherit", path=full_path)
+        changes.append(("", "inherit", full_path))
 
     # Set owner permission for username if not already set
-    user_owns = any(perm.user_name == registration.username and perm.access_name == "own" for perm in current_perms)
+    user_owns = any(perm["user_name"] == registration.username and perm["access_name"] == "own" for perm in current_perms)
     if not user_owns:
-        server.chmod(username=registration.username, permission="own", path=full_path)
+        changes.append((registration.username, "own", full_path))
 
     # Set owner permission for irods_user if specified and not already set
     if registration.irods_user is not None:
-        irods_user_owns = any(perm.user_name == registration.irods_user and perm.access_name == "own" for perm in current_perms)
+        irods_user_owns = any(perm["user_name"] == registration.irods_user and perm["access_name"] == "own" for perm in current_perms)
         if not irods_user_owns:
-            server.chmod(username=registration.irods_user, permission="own", path=full_path)
+            changes.append((registration.irods_user, "own", full_path))
+
+    if changes:
+        await run_blocking(server.chmod_many, changes)
 
     return {
         "user": registration.username,